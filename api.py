@@ -1,11 +1,18 @@
 import uvicorn
 import os
+import asyncio
+import anyio
 from fastapi import FastAPI, APIRouter, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
 from contextlib import asynccontextmanager
 from src.reader.reader import start_reader, stop_reader
-from src.api.routes.auth import router as auth_router
+from src.api.routes.auth import (
+    router as auth_router,
+    get_email_settings,
+    get_ses_client,
+)
 from src.api.routes.users import router as users_router
 from src.api.routes.rfids import router as rfids_router
 from src.api.routes.pins import router as pins_router
@@ -16,27 +23,65 @@ from src.api.routes.reader import router as reader_router
 from src.api.routes.api_keys import router as api_keys_router
 from src.api.exceptions import configure_exception_handlers
 from src.api.dependencies import get_current_user
+import src.db as db
+from src.logger import logger
 
 load_dotenv()
 
+PURGE_INTERVAL = 3600  # seconds between sweeps of expired tokens and login codes
+
+
+async def purge_expired_credentials_periodically():
+    # Expired rows are never read again; dropping them keeps the auth tables small
+    while True:
+        try:
+            await asyncio.to_thread(db.purge_expired_credentials)
+        except Exception as e:
+            logger.error(f"Failed to purge expired credentials: {e}")
+        await asyncio.sleep(PURGE_INTERVAL)
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # Sync request handlers run on anyio worker threads; size that pool explicitly
+    anyio.to_thread.current_default_thread_limiter().total_tokens = int(
+        os.getenv("THREADPOOL_SIZE", 40)
+    )
+    db.init_db()
+    db.warm_up_pool()
+    if not get_email_settings().complete:
+        logger.error(
+            "AWS_REGION and AWS_SES_SENDER_EMAIL must be set to send login codes."
+        )
+    try:
+        get_ses_client()
+    except Exception as e:
+        logger.error(f"Failed to initialize email service: {e}")
+    purge_task = asyncio.create_task(purge_expired_credentials_periodically())
     start_reader()
     yield
     await stop_reader()
+    purge_task.cancel()
 
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
-origins = ["*"]
+# Comma-separated list of origins allowed to call the API (i.e. the web app)
+origins = [
+    origin.strip().rstrip("/")
+    for origin in os.getenv(
+        "CORS_ORIGINS", f"http://localhost:{os.getenv('WEB_APP_PORT', 8050)}"
+    ).split(",")
+    if origin.strip()
+]
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "PUT", "PATCH", "DELETE"],
+    allow_headers=["Authorization", "Content-Type", "X-API-Key"],
+    max_age=86400,  # let browsers cache preflight responses for a day
 )
 
 # Create a new router for authenticated routes
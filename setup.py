@@ -123,9 +123,11 @@ def setup_from_csv(csv_file: str) -> bool:
     data = load_csv_data(csv_file)
     if not data:
         return False
-    for row in data:
-        user_data = process_csv_row(row)
-        if user_data:
+    users = [user_data for row in data if (user_data := process_csv_row(row))]
+    # Insert everything at once; if that is rejected (e.g. an email already exists),
+    # add row by row so the valid users still get in and each failure is logged
+    if db.add_users(users) is None:
+        for user_data in users:
             add_user(user_data)
     return True
 
@@ -133,10 +135,12 @@ def setup_from_csv(csv_file: str) -> bool:
 def setup_interactively() -> None:
     num_apartments = int(input("How many apartments would you like to set up? "))
 
-    for i in range(num_apartments):
-        apartment_number = i + 1
-        db.add_apartment(apartment_number)
-        logger.info(f"Added apartment {apartment_number}")
+    with db.get_db() as session:
+        for i in range(num_apartments):
+            apartment_number = i + 1
+            db.add_apartment(apartment_number, db=session)
+            logger.info(f"Added apartment {apartment_number}")
+        session.commit()
 
     add_users = (
         input("Do you want to add users to the apartments? (y/n) ").lower() == "y"
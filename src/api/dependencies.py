@@ -1,12 +1,12 @@
+import asyncio
 from fastapi import Depends, Request, Security
 from fastapi.security import OAuth2PasswordBearer
 from .exceptions import APIException
 from fastapi.security import APIKeyHeader
 from sqlalchemy.orm import Session
-from src.db import get_db
+from src.db import get_db, get_user_by_token
 from src.api.utils import verify_api_key
 from src.db import User
-from src.utils import hash_secret
 
 api_key_header = APIKeyHeader(name="X-API-Key")
 
@@ -20,7 +20,15 @@ async def get_current_user_from_api_key(
     return api_key_obj.user
 
 
-async def get_current_user(request: Request, db: Session = Depends(get_db)) -> User:
+def _get_user_by_api_key(api_key: str):
+    with get_db() as session:
+        api_key_obj = verify_api_key(session, api_key)
+    return api_key_obj.user if api_key_obj else None
+
+
+async def _authenticate(request: Request, use_cache: bool) -> User:
+    # This runs on the event loop for every authenticated request, so the database
+    # lookups below go to a worker thread instead of blocking it
     # Check for API key in header
     api_key = request.headers.get("X-API-Key")
 
@@ -29,10 +37,9 @@ async def get_current_user(request: Request, db: Session = Depends(get_db)) -> U
         api_key = request.query_params.get("api_key")
 
     if api_key:
-        with db as session:  # Use the context manager properly
-            api_key_obj = verify_api_key(session, api_key)
-        if api_key_obj:
-            return api_key_obj.user
+        user = await asyncio.to_thread(_get_user_by_api_key, api_key)
+        if user:
+            return user
 
     # If no API key or invalid, fall back to bearer token authentication
     authorization: str = request.headers.get("Authorization")
@@ -40,16 +47,22 @@ async def get_current_user(request: Request, db: Session = Depends(get_db)) -> U
         raise APIException(status_code=401, detail="No valid authentication provided")
 
     token = authorization.replace("Bearer ", "")
-    with db as session:  # Use the context manager properly
-        token_hash = hash_secret(token)
-        user = (
-            session.query(User).filter(User.tokens.any(token_hash=token_hash)).first()
-        )
+    user = await asyncio.to_thread(get_user_by_token, token, use_cache)
     if user:
         return user
     raise APIException(status_code=401, detail="Invalid authentication")
 
 
+async def get_current_user(request: Request) -> User:
+    return await _authenticate(request, use_cache=True)
+
+
+async def get_current_user_uncached(request: Request) -> User:
+    # For routes that manage tokens and API keys: the bearer token is always checked
+    # against the database, so a token revoked by another worker is refused at once
+    return await _authenticate(request, use_cache=False)
+
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
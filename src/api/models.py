@@ -141,16 +141,16 @@ class OneTimeAccessCreate(BaseModel):
 class RecurringScheduleResponse(BaseModel):
     id: int
     day_of_week: int
-    start_time: str
-    end_time: str
+    start_time: time
+    end_time: time
 
 
 class OneTimeAccessResponse(BaseModel):
     id: int
-    start_date: str
-    end_date: str
-    start_time: str
-    end_time: str
+    start_date: date
+    end_date: date
+    start_time: time
+    end_time: time
 
 
 class GuestSchedulesResponse(BaseModel):
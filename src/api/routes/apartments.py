@@ -1,7 +1,8 @@
-from fastapi import APIRouter, status, Response, Depends
+import asyncio
+from fastapi import APIRouter, Request, status, Response, Depends
 from ..models import ApartmentCreate, ApartmentResponse, ApartmentUpdate, User
 from ..exceptions import APIException
-from ..utils import apartment_return_format
+from ..utils import apartment_return_format, check_etag
 from ..dependencies import get_current_user
 import src.db as db
 
@@ -9,14 +10,32 @@ router = APIRouter(prefix="/apartments", tags=["apartments"])
 
 
 @router.get("", status_code=status.HTTP_200_OK, response_model=list[ApartmentResponse])
-def list_apartments(current_user: User = Depends(get_current_user)):
+async def list_apartments(
+    request: Request,
+    response: Response,
+    current_user: User = Depends(get_current_user),
+):
+    not_modified = check_etag(
+        request,
+        response,
+        "apartments",
+        db.get_table_versions("apartments"),
+        current_user.role,
+        current_user.apartment_id,
+    )
+    if not_modified:
+        return not_modified
+
     if current_user.role == "admin":
-        return [
-            apartment_return_format(apartment) for apartment in db.get_all_apartments()
-        ]
+        apartments = await asyncio.to_thread(db.get_all_apartments)
+        return [apartment_return_format(apartment) for apartment in apartments]
     else:
-        # For non-admin users, return only their apartment
-        return [apartment_return_format(current_user.apartment)]
+        # For non-admin users, return only their apartment. It is read here rather
+        # than taken from the cached current_user, so it is not older than the ETag
+        apartment = await asyncio.to_thread(
+            db.get_apartment, current_user.apartment_id
+        )
+        return [apartment_return_format(apartment)] if apartment else []
 
 
 @router.post("", status_code=status.HTTP_201_CREATED, response_model=ApartmentResponse)
@@ -1,9 +1,10 @@
+import asyncio
 from fastapi import APIRouter, status, Response, Depends
 from typing import List
 import secrets
 import hashlib
 from src.api.models import APIKeyCreate, APIKeyResponse, APIKeyWithSecret
-from src.api.dependencies import get_current_user
+from src.api.dependencies import get_current_user_uncached
 from src.api.exceptions import APIException
 import src.db as db
 
@@ -21,7 +22,7 @@ def generate_api_key() -> tuple[str, str, str]:
 @router.post("", response_model=APIKeyWithSecret)
 async def create_api_key(
     data: APIKeyCreate,
-    current_user: db.User = Depends(get_current_user),
+    current_user: db.User = Depends(get_current_user_uncached),
 ):
     if current_user.role == "guest":
         raise APIException(
@@ -31,7 +32,7 @@ async def create_api_key(
 
     # If a user_id is provided in the request, we're creating a key for another user
     if data.user_id:
-        target_user = db.get_user(data.user_id)
+        target_user = await asyncio.to_thread(db.get_user, data.user_id)
         if not target_user:
             raise APIException(status_code=404, detail="User not found")
 
@@ -57,7 +58,8 @@ async def create_api_key(
 
     api_key, suffix, key_hash = generate_api_key()
 
-    db_api_key = db.add_api_key(
+    db_api_key = await asyncio.to_thread(
+        db.add_api_key,
         suffix=suffix,
         key_hash=key_hash,
         description=data.description,
@@ -75,14 +77,16 @@ async def create_api_key(
 
 
 @router.get("", status_code=status.HTTP_200_OK)
-def list_api_keys(current_user: db.User = Depends(get_current_user)):
+async def list_api_keys(current_user: db.User = Depends(get_current_user_uncached)):
     if current_user.role == "admin":
-        api_keys = db.get_all_api_keys()
+        api_keys = await asyncio.to_thread(db.get_all_api_keys)
     elif current_user.role == "apartment_admin":
-        api_keys = db.get_apartment_api_keys(current_user.apartment_id)
+        api_keys = await asyncio.to_thread(
+            db.get_apartment_api_keys, current_user.apartment_id
+        )
     else:
         # Regular users can only see their own API keys
-        api_keys = db.get_user_api_keys(current_user.id)
+        api_keys = await asyncio.to_thread(db.get_user_api_keys, current_user.id)
 
     return [
         APIKeyResponse(
@@ -99,9 +103,9 @@ def list_api_keys(current_user: db.User = Depends(get_current_user)):
 @router.delete("/{key_suffix}")
 async def delete_api_key(
     key_suffix: str,
-    current_user: db.User = Depends(get_current_user),
+    current_user: db.User = Depends(get_current_user_uncached),
 ):
-    api_key = db.get_api_key(key_suffix)
+    api_key = await asyncio.to_thread(db.get_api_key, key_suffix)
     if not api_key:
         raise APIException(status_code=404, detail="API key not found")
 
@@ -110,7 +114,7 @@ async def delete_api_key(
         pass
     elif current_user.role == "apartment_admin":
         # Apartment admins can only delete API keys from their apartment
-        key_owner = db.get_api_key_owner(api_key.user_id)
+        key_owner = await asyncio.to_thread(db.get_api_key_owner, api_key.user_id)
         if key_owner.apartment_id != current_user.apartment_id:
             raise APIException(
                 status_code=403,
@@ -124,6 +128,6 @@ async def delete_api_key(
                 detail="You can only delete your own API keys",
             )
 
-    if db.delete_api_key(key_suffix):
+    if await asyncio.to_thread(db.delete_api_key, key_suffix):
         return {"message": "API key deleted"}
     raise APIException(status_code=500, detail="Failed to delete API key")
@@ -1,4 +1,5 @@
-from fastapi import APIRouter, Request, status, Response, Depends
+import asyncio
+from fastapi import APIRouter, BackgroundTasks, Request, status, Response, Depends
 from fastapi.security import OAuth2PasswordBearer
 from ..models import (
     LoginRequest,
@@ -8,30 +9,79 @@ from ..models import (
     User,
 )
 from ..exceptions import APIException
-from ..dependencies import get_current_token, get_current_user
+from ..dependencies import get_current_token, get_current_user_uncached
 from ..utils import check_rate_limit, build_user_response
 import src.db as db
 import src.utils as utils
 import os
 import boto3
 from src.logger import logger
+from botocore.config import Config
 from botocore.exceptions import ClientError, EndpointConnectionError
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
 import time as time_module
-from secrets import token_urlsafe
-import random
+from secrets import choice, token_urlsafe
 
 router = APIRouter(prefix="/auth", tags=["auth"])
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+LOGIN_CODE_ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+LOGIN_CODE_LENGTH = 8
+
+LOGIN_EMAIL_SUBJECT = "Your Login Code"
+LOGIN_EMAIL_HTML_PREFIX = "<html><body><center><h1>Your Login Code</h1><p>Please use this code to log in:</p><p>"
+LOGIN_EMAIL_HTML_SUFFIX = "</p></center></body></html>"
+
+
+@dataclass(frozen=True)
+class EmailSettings:
+    web_app_url: str
+    aws_region: Optional[str]
+    sender: Optional[str]
+
+    @property
+    def complete(self):
+        return bool(self.aws_region and self.sender)
+
+
+@lru_cache()
+def get_email_settings() -> EmailSettings:
+    # Read once; the environment doesn't change while the server runs
+    web_app_url = os.getenv(
+        "WEB_APP_URL", f"http://localhost:{os.getenv('WEB_APP_PORT', 8050)}/"
+    )
+    if not web_app_url.endswith("/"):
+        web_app_url += "/"
+    return EmailSettings(
+        web_app_url=web_app_url,
+        aws_region=os.getenv("AWS_REGION"),
+        sender=os.getenv("AWS_SES_SENDER_EMAIL"),
+    )
+
+
+@lru_cache()
+def get_ses_client():
+    # Building a boto3 client loads the service model and credentials, so do it once
+    return boto3.client(
+        "ses",
+        region_name=get_email_settings().aws_region,
+        config=Config(
+            max_pool_connections=50,
+            retries={"max_attempts": 2, "mode": "standard"},
+        ),
+    )
+
 
 @router.post("/magic-links", status_code=status.HTTP_202_ACCEPTED)
-def send_magic_link(request: LoginRequest):
+def send_magic_link(request: LoginRequest, background_tasks: BackgroundTasks):
     success_message = (
         "A login code has been sent to your email. Please enter the code below."
     )
 
-    login_code = "".join(random.choices("0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ", k=8))
+    login_code = "".join(choice(LOGIN_CODE_ALPHABET) for _ in range(LOGIN_CODE_LENGTH))
     hashed_token = utils.hash_secret(login_code)
     email = request.email
 
@@ -44,32 +94,25 @@ def send_magic_link(request: LoginRequest):
         logger.error(f"Login code requested for a non-existing user {email}.")
         return success_message  # for security reasons, we don't want to leak if the user exists
 
-    url_to_use = os.getenv(
-        "WEB_APP_URL", f"http://localhost:{os.getenv('WEB_APP_PORT', 8050)}/"
-    )
-    if not url_to_use.endswith("/"):
-        url_to_use += "/"
-
-    aws_region = os.getenv("AWS_REGION")
-    if not aws_region:
+    settings = get_email_settings()
+    if not settings.complete:
         raise APIException(status_code=500, detail="Server configuration error")
 
-    try:
-        ses_client = boto3.client("ses", region_name=aws_region)
-    except Exception:
-        raise APIException(status_code=500, detail="Failed to initialize email service")
+    body_html = LOGIN_EMAIL_HTML_PREFIX + login_code + LOGIN_EMAIL_HTML_SUFFIX
 
-    sender = os.getenv("AWS_SES_SENDER_EMAIL")
-    if not sender:
-        raise APIException(status_code=500, detail="Server configuration error")
+    # <p>Alternatively, you can click this link to log in: <a href='{settings.web_app_url}login?login_code={login_code}'>Log In</a></p></center></body></html>""" # todo: need to pass the email to the login page and update the frontend to use it
 
-    subject = "Your Login Code"
-    body_html = f"""<html><body><center><h1>Your Login Code</h1><p>Please use this code to log in:</p><p>{login_code}</p>"""
+    # The SES round trip doesn't affect the response, so send after replying
+    background_tasks.add_task(
+        send_login_email, email, settings.sender, LOGIN_EMAIL_SUBJECT, body_html
+    )
+    logger.debug(f"Login code: {login_code}")
+    return success_message
 
-    # <p>Alternatively, you can click this link to log in: <a href='{url_to_use}login?login_code={login_code}'>Log In</a></p></center></body></html>""" # todo: need to pass the email to the login page and update the frontend to use it
 
+def send_login_email(email, sender, subject, body_html):
     try:
-        response = ses_client.send_email(
+        response = get_ses_client().send_email(
             Destination={"ToAddresses": [email]},
             Message={
                 "Body": {"Html": {"Charset": "UTF-8", "Data": body_html}},
@@ -78,38 +121,24 @@ def send_magic_link(request: LoginRequest):
             Source=sender,
         )
         logger.info(f"Email sent: {response}")
-        logger.debug(f"Login code: {login_code}")
-        return success_message
     except EndpointConnectionError as e:
         logger.error(f"Failed to connect to AWS SES endpoint: {str(e)}")
-        raise APIException(
-            status_code=500,
-            detail="Failed to connect to email service. Please check your AWS region configuration.",
-        )
     except ClientError as e:
         logger.error(f"Failed to send email: {str(e)}")
-        raise APIException(
-            status_code=500,
-            detail="Failed to send email. Please check your AWS SES configuration.",
-        )
     except Exception as e:
         logger.error(f"Unexpected error while sending email: {str(e)}")
-        raise APIException(
-            status_code=500,
-            detail="An unexpected error occurred while sending the email.",
-        )
 
 
 @router.post(
     "/verify", status_code=status.HTTP_200_OK, response_model=VerifyAuthResponse
 )
-def verify_authentication(
+async def verify_authentication(
     request: Request,
-    current_user: User = Depends(get_current_user),  # Add the dependency here
+    current_user: User = Depends(get_current_user_uncached),  # Add the dependency here
 ):
     current_token = get_current_token(request)
     new_expiration = int(time_module.time()) + 31536000  # 1 year from now
-    db.extend_token_expiration(current_token, new_expiration)
+    await asyncio.to_thread(db.extend_token_expiration, current_token, new_expiration)
     return VerifyAuthResponse(
         status="authenticated", user=build_user_response(current_user)
     )
@@ -117,19 +146,11 @@ def verify_authentication(
 
 @router.delete("/tokens/current", status_code=status.HTTP_204_NO_CONTENT)
 def logout(
-    current_user: User = Depends(get_current_user),
+    current_user: User = Depends(get_current_user_uncached),
     current_token: str = Depends(get_current_token),
 ):
-    email = current_user.email
-    user = db.get_user(email)
-    if user:
-        tokens = user.tokens if user.tokens else []
-        if tokens and current_token in [token.token_hash for token in tokens]:
-            token_to_remove = next(
-                token for token in tokens if token.token_hash == current_token
-            )
-            db.delete_token(token_to_remove.id)
-            return Response(status_code=status.HTTP_204_NO_CONTENT)
+    if db.delete_token_by_hash(current_user.id, utils.hash_secret(current_token)):
+        return Response(status_code=status.HTTP_204_NO_CONTENT)
 
     raise APIException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized")
 
@@ -148,32 +169,26 @@ def exchange_code(login_attempt: LoginCodeAttempt, request: Request):
             status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid login code"
         )
 
-    user = db.get_user_by_login_code(login_code)
-    if not user or user.email != email:
+    now = int(time_module.time())
+    bearer_token = token_urlsafe(16)
+    user, expired = db.redeem_login_code(
+        email,
+        login_code,
+        utils.hash_secret(bearer_token),
+        now + 31536000,  # 1 year expiration
+        now,
+    )
+    if not user:
         raise APIException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid email or login code",
         )
-
-    # Check if the code has expired
-    current_time = int(time_module.time())
-    if db.is_login_code_expired(user.id, login_code, current_time):
-        db.remove_login_code(user.id, login_code)
+    if expired:
         raise APIException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Login code has expired. Please request a new one.",
         )
 
-    # Generate and save new bearer token
-    bearer_token = token_urlsafe(16)
-    bearer_token_hashed = utils.hash_secret(bearer_token)
-    db.save_token(
-        user.id, bearer_token_hashed, int(time_module.time()) + 31536000
-    )  # 1 year expiration
-
-    # Remove the used login code
-    db.remove_login_code(user.id, login_code)
-
     return {
         "access_token": bearer_token,
         "token_type": "bearer",
@@ -1,3 +1,4 @@
+import asyncio
 from fastapi import APIRouter, status, Response, Depends
 from ..models import (
     RecurringScheduleCreate,
@@ -79,14 +80,16 @@ def create_one_time_access(
 
 
 @router.get("/{user_id}/schedules", status_code=status.HTTP_200_OK)
-def list_guest_schedules(user_id: int, current_user: User = Depends(get_current_user)):
+async def list_guest_schedules(
+    user_id: int, current_user: User = Depends(get_current_user)
+):
     if (
         current_user.role not in ["admin", "apartment_admin"]
         and current_user.id != user_id
     ):
         raise APIException(status_code=403, detail="Insufficient permissions")
 
-    guest_user = db.get_user(user_id)
+    guest_user = await asyncio.to_thread(db.get_user, user_id)
     if not guest_user or guest_user.role != "guest":
         raise APIException(status_code=400, detail="Invalid guest user")
 
@@ -99,26 +102,29 @@ def list_guest_schedules(user_id: int, current_user: User = Depends(get_current_
             detail="Cannot view schedules for guests from other apartments",
         )
 
-    recurring_schedules = db.get_recurring_schedules_by_user(user_id)
-    one_time_access = db.get_one_time_accesses_by_user(user_id)
+    # The two schedule tables are independent, so fetch them concurrently
+    recurring_schedules, one_time_access = await asyncio.gather(
+        asyncio.to_thread(db.get_recurring_schedules_by_user, user_id),
+        asyncio.to_thread(db.get_one_time_accesses_by_user, user_id),
+    )
 
     return GuestSchedulesResponse(
         recurring_schedules=[
             {
                 "id": schedule.id,
                 "day_of_week": schedule.day_of_week,
-                "start_time": schedule.start_time.isoformat(),
-                "end_time": schedule.end_time.isoformat(),
+                "start_time": schedule.start_time,
+                "end_time": schedule.end_time,
             }
             for schedule in recurring_schedules
         ],
         one_time_access=[
             {
                 "id": access.id,
-                "start_date": access.start_date.isoformat(),
-                "end_date": access.end_date.isoformat(),
-                "start_time": access.start_time.isoformat(),
-                "end_time": access.end_time.isoformat(),
+                "start_date": access.start_date,
+                "end_date": access.end_date,
+                "start_time": access.start_time,
+                "end_time": access.end_time,
             }
             for access in one_time_access
         ],
@@ -139,8 +145,8 @@ def delete_recurring_schedule(
         raise APIException(status_code=404, detail="Schedule not found")
 
     if current_user.role == "apartment_admin":
-        guest_user = db.get_user(schedule.user_id)
-        if guest_user.apartment_id != current_user.apartment_id:
+        guest_apartment_id = db.get_user_apartment_id(schedule.user_id)
+        if guest_apartment_id != current_user.apartment_id:
             raise APIException(
                 status_code=403,
                 detail="Cannot remove schedules for guests from other apartments",
@@ -163,8 +169,8 @@ def delete_one_time_access(
         raise APIException(status_code=404, detail="One-time access not found")
 
     if current_user.role == "apartment_admin":
-        guest_user = db.get_user(access.user_id)
-        if guest_user.apartment_id != current_user.apartment_id:
+        guest_apartment_id = db.get_user_apartment_id(access.user_id)
+        if guest_apartment_id != current_user.apartment_id:
             raise APIException(
                 status_code=403,
                 detail="Cannot remove access for guests from other apartments",
@@ -1,7 +1,9 @@
-from fastapi import APIRouter, status, Response, Depends
+import asyncio
+from fastapi import APIRouter, Request, status, Response, Depends
 from ..models import PINCreate, PINResponse, PINUpdate, User
 from ..exceptions import APIException
 from ..dependencies import get_current_user
+from ..utils import check_etag
 import src.db as db
 import src.utils as utils
 import random
@@ -50,12 +52,12 @@ def create_pin(pin_request: PINCreate, current_user: User = Depends(get_current_
             )
 
         # Generate a random unique PIN
+        all_pins = db.get_pin_credentials()  # load once, not on every retry
         while True:
             pin = "".join(
                 random.choices("0123456789", k=int(os.getenv("PIN_LENGTH", 4)))
             )
             # Check for uniqueness
-            all_pins = db.get_all_pins()
             is_unique = True
             for existing_pin in all_pins:
                 if utils.hash_secret(pin, existing_pin.salt) == existing_pin.hashed_pin:
@@ -148,13 +150,29 @@ def delete_pin(pin_id: int, current_user: User = Depends(get_current_user)):
 
 
 @router.get("", status_code=status.HTTP_200_OK, response_model=list[PINResponse])
-def list_pins(current_user: User = Depends(get_current_user)):
+async def list_pins(
+    request: Request,
+    response: Response,
+    current_user: User = Depends(get_current_user),
+):
+    if current_user.role not in ["admin", "apartment_admin"]:
+        raise APIException(status_code=403, detail="Guests cannot list PINs")
+
+    not_modified = check_etag(
+        request,
+        response,
+        "pins",
+        db.get_table_versions("pins", "users"),
+        current_user.role,
+        current_user.apartment_id,
+    )
+    if not_modified:
+        return not_modified
+
     if current_user.role == "admin":
-        pins = db.get_all_pins()
-    elif current_user.role == "apartment_admin":
-        pins = db.get_apartment_pins(current_user.apartment.id)
+        pins = await asyncio.to_thread(db.get_pin_rows)
     else:
-        raise APIException(status_code=403, detail="Guests cannot list PINs")
+        pins = await asyncio.to_thread(db.get_pin_rows, current_user.apartment.id)
 
     return [
         PINResponse(
@@ -162,7 +180,7 @@ def list_pins(current_user: User = Depends(get_current_user)):
             label=pin.label,
             created_at=str(pin.created_at),
             user_id=pin.user_id,
-            user_email=pin.user.email,
+            user_email=pin.user_email,
         )
         for pin in pins
     ]
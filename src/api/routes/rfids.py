@@ -1,7 +1,8 @@
-from fastapi import APIRouter, status, Response, Depends
+import asyncio
+from fastapi import APIRouter, Request, status, Response, Depends
 from ..models import RFIDCreate, RFIDResponse, User
 from ..exceptions import APIException
-from ..utils import build_user_response
+from ..utils import build_user_response, check_etag
 from ..dependencies import get_current_user
 import src.db as db
 import src.utils as utils
@@ -21,10 +22,6 @@ router = APIRouter(prefix="/rfids", tags=["rfids"])
 def create_rfid(
     rfid_request: RFIDCreate, current_user: User = Depends(get_current_user)
 ):
-    salt = utils.generate_salt()
-    hashed_uuid = utils.hash_secret(payload=rfid_request.uuid, salt=salt)
-    last_four_digits = rfid_request.uuid[-4:]
-
     if rfid_request.user_id:
         target_user = db.get_user(rfid_request.user_id)
         if not target_user:
@@ -51,6 +48,11 @@ def create_rfid(
         user_id = current_user.id
         target_user = current_user
 
+    # Only hash once the request has passed the permission checks
+    salt = utils.generate_salt()
+    hashed_uuid = utils.hash_secret(payload=rfid_request.uuid, salt=salt)
+    last_four_digits = rfid_request.uuid[-4:]
+
     rfid = db.save_rfid(
         user_id, hashed_uuid, salt, last_four_digits, rfid_request.label
     )
@@ -124,13 +126,29 @@ def delete_rfid(rfid_id: int, current_user: User = Depends(get_current_user)):
 
 
 @router.get("", status_code=status.HTTP_200_OK)
-def list_rfids(current_user: User = Depends(get_current_user)):
+async def list_rfids(
+    request: Request,
+    response: Response,
+    current_user: User = Depends(get_current_user),
+):
+    if current_user.role not in ["admin", "apartment_admin"]:
+        raise APIException(status_code=403, detail="Guests cannot list RFIDs")
+
+    not_modified = check_etag(
+        request,
+        response,
+        "rfids",
+        db.get_table_versions("rfids", "users"),
+        current_user.role,
+        current_user.apartment_id,
+    )
+    if not_modified:
+        return not_modified
+
     if current_user.role == "admin":
-        rfids = db.get_all_rfids()
-    elif current_user.role == "apartment_admin":
-        rfids = db.get_apartment_rfids(current_user.apartment.id)
+        rfids = await asyncio.to_thread(db.get_rfid_rows)
     else:
-        raise APIException(status_code=403, detail="Guests cannot list RFIDs")
+        rfids = await asyncio.to_thread(db.get_rfid_rows, current_user.apartment.id)
 
     return [
         RFIDResponse(
@@ -138,7 +156,7 @@ def list_rfids(current_user: User = Depends(get_current_user)):
             label=rfid.label,
             created_at=str(rfid.created_at),
             user_id=rfid.user_id,
-            user_email=rfid.user.email,
+            user_email=rfid.user_email,
             last_four_digits=rfid.last_four_digits,
         )
         for rfid in rfids
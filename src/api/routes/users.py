@@ -1,4 +1,5 @@
-from fastapi import APIRouter, status, Response, Path, Depends
+import asyncio
+from fastapi import APIRouter, Request, status, Response, Path, Depends
 from ..models import (
     UserCreate,
     UserResponse,
@@ -7,12 +8,22 @@ from ..models import (
 )
 from ..exceptions import APIException
 from ..dependencies import get_current_user
-from ..utils import build_user_response
+from ..utils import build_user_response, check_etag
 import src.db as db
 
 router = APIRouter(prefix="/users", tags=["users"])
 
 
+def _can_read_user(current_user: User, user_id: int) -> bool:
+    """Admins can read anyone, apartment admins their apartment, others themselves."""
+    if current_user.role == "admin" or current_user.id == user_id:
+        return True
+    return (
+        current_user.role == "apartment_admin"
+        and current_user.apartment_id == db.get_user_apartment_id(user_id)
+    )
+
+
 @router.post("", status_code=status.HTTP_201_CREATED, response_model=UserResponse)
 def create_user(
     new_user: UserCreate, current_user: User = Depends(get_current_user)
@@ -47,14 +58,6 @@ def create_user(
             detail="You can only create users for your own apartment",
         )
 
-    if new_user.email:
-        existing_user = db.get_user(new_user.email)
-        if existing_user:
-            raise APIException(
-                status_code=status.HTTP_409_CONFLICT,
-                detail=f"User with email {new_user.email} already exists",
-            )
-
     created_user = db.add_user(
         {
             "name": new_user.name,
@@ -64,18 +67,41 @@ def create_user(
             "creator_id": current_user.id,
         }
     )
+    if not created_user:
+        raise APIException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"User with email {new_user.email} already exists",
+        )
 
     return build_user_response(created_user)
 
 
 @router.get("", status_code=status.HTTP_200_OK, response_model=list[UserResponse])
-def list_users(current_user: User = Depends(get_current_user)):
+async def list_users(
+    request: Request,
+    response: Response,
+    current_user: User = Depends(get_current_user),
+):
+    if current_user.role not in ["admin", "apartment_admin"]:
+        raise APIException(status_code=403, detail="Guests cannot list users")
+
+    not_modified = check_etag(
+        request,
+        response,
+        "users",
+        db.get_table_versions("users", "apartments"),
+        current_user.role,
+        current_user.apartment_id,
+    )
+    if not_modified:
+        return not_modified
+
     if current_user.role == "admin":
-        users = db.get_all_users()
-    elif current_user.role == "apartment_admin":
-        users = db.get_apartment_users(current_user.apartment.id)
+        users = await asyncio.to_thread(db.get_all_users)
     else:
-        raise APIException(status_code=403, detail="Guests cannot list users")
+        users = await asyncio.to_thread(
+            db.get_apartment_users, current_user.apartment.id
+        )
 
     return [build_user_response(user) for user in users]
 
@@ -185,18 +211,11 @@ def list_user_rfids(
     current_user: User = Depends(get_current_user),
     user_id: int = Path(..., description="The ID of the user whose RFIDs to list"),
 ):
-    if current_user.role == "admin":
-        rfids = db.get_user_rfids(user_id)
-    elif (
-        current_user.role == "apartment_admin"
-        and current_user.apartment_id == db.get_user(user_id).apartment_id
-    ):
-        rfids = db.get_user_rfids(user_id)
-    elif current_user.id == user_id:
-        rfids = db.get_user_rfids(user_id)
-    else:
+    if not _can_read_user(current_user, user_id):
         raise APIException(status_code=403, detail="Insufficient permissions")
 
+    rfids = db.get_rfid_rows(user_id=user_id)
+
     return [
         {
             "id": rfid.id,
@@ -213,18 +232,11 @@ def list_user_pins(
     current_user: User = Depends(get_current_user),
     user_id: int = Path(..., description="User ID to fetch pins for"),
 ):
-    if current_user.role == "admin":
-        pins = db.get_user_pins(user_id)
-    elif (
-        current_user.role == "apartment_admin"
-        and current_user.apartment_id == db.get_user(user_id).apartment_id
-    ):
-        pins = db.get_user_pins(user_id)
-    elif current_user.id == user_id:
-        pins = db.get_user_pins(user_id)
-    else:
+    if not _can_read_user(current_user, user_id):
         raise APIException(status_code=403, detail="Insufficient permissions")
 
+    pins = db.get_pin_rows(user_id=user_id)
+
     return [
         {
             "id": pin.id,
@@ -1,13 +1,42 @@
-from collections import defaultdict
+from collections import OrderedDict, deque
+from functools import lru_cache
+import os
+import threading
 import time
-from fastapi import HTTPException
+from fastapi import HTTPException, Request, Response
 import hashlib
-from src.db import APIKey
-from sqlalchemy.orm import joinedload
+import secrets
+from src.db import APIKey, User
+from src.logger import logger
+from sqlalchemy.orm import joinedload, raiseload
+
+try:
+    import redis  # type: ignore
+except ImportError:
+    redis = None
 
-rate_limit = defaultdict(list)
 MAX_ATTEMPTS = 5
 RATE_LIMIT_DURATION = 60  # 1 minute
+RATE_LIMIT_MAX_TRACKED_IPS = 16_384
+
+# IP -> timestamps of its recent attempts, least recently seen IP first
+rate_limit = OrderedDict()
+rate_limit_lock = threading.Lock()
+
+# Atomically counts an attempt and starts the window on the first one
+RATE_LIMIT_SCRIPT = """
+local attempts = redis.call('INCR', KEYS[1])
+if attempts == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return attempts
+"""
+
+# Mixed into every ETag so tags issued before a restart are never honoured
+ETAG_SEED = secrets.token_hex(8)
+# The table versions in ETags only count commits made by this process. Writes
+# from other workers or setup.py are picked up once the current time bucket ends.
+ETAG_MAX_AGE = int(os.getenv("ETAG_MAX_AGE", 60))
 
 
 def verify_api_key(db, api_key: str):
@@ -27,32 +56,98 @@ def verify_api_key(db, api_key: str):
     # Hash the full API key
     key_hash = hashlib.sha256(api_key.encode()).hexdigest()
 
-    # Query the database for a matching API key and eagerly load the user relationship
+    # Query the database for a matching API key and eagerly load the user relationship.
+    # The user gets the same loader options as on the bearer token path, so handlers
+    # see the same attributes whichever way the request authenticated.
     api_key_obj = (
         db.query(APIKey)
         .filter(
             APIKey.key_hash == key_hash,
             APIKey.is_active,
         )
-        .options(joinedload(APIKey.user))
+        .options(
+            joinedload(APIKey.user).options(
+                joinedload(User.apartment), raiseload("*")
+            )
+        )
         .first()
     )
 
     return api_key_obj
 
 
+@lru_cache()
+def get_rate_limit_script():
+    # With REDIS_URL set, attempts are counted in Redis so that all workers share
+    # one limit; otherwise each process keeps its own in memory
+    redis_url = os.getenv("REDIS_URL")
+    if not redis_url:
+        return None
+    if redis is None:
+        logger.error(
+            "REDIS_URL is set but the redis package is not installed. Falling back to in-memory rate limiting."
+        )
+        return None
+    return redis.Redis.from_url(redis_url).register_script(RATE_LIMIT_SCRIPT)
+
+
 def check_rate_limit(ip_address):
-    now = time.time()
-    request_times = rate_limit[ip_address]
-    request_times = [t for t in request_times if now - t < RATE_LIMIT_DURATION]
+    rate_limit_script = get_rate_limit_script()
+    if rate_limit_script is not None:
+        try:
+            attempts = rate_limit_script(
+                keys=[f"rl:{ip_address}"], args=[RATE_LIMIT_DURATION]
+            )
+        except redis.RedisError as e:
+            logger.error(f"Redis rate limiting failed, using in-memory limit: {e}")
+        else:
+            if attempts > MAX_ATTEMPTS:
+                raise HTTPException(
+                    status_code=429, detail="Too many attempts. Please try again later."
+                )
+            return
+
+    # Only relative windows matter here, so use a clock that can't jump
+    now = time.monotonic()
+    with rate_limit_lock:
+        request_times = rate_limit.get(ip_address)
+        if request_times is None:
+            # Only the last MAX_ATTEMPTS timestamps matter, so each IP gets a ring buffer
+            request_times = rate_limit[ip_address] = deque(maxlen=MAX_ATTEMPTS)
+            if len(rate_limit) > RATE_LIMIT_MAX_TRACKED_IPS:
+                rate_limit.popitem(last=False)
+        else:
+            rate_limit.move_to_end(ip_address)
+
+        while request_times and now - request_times[0] >= RATE_LIMIT_DURATION:
+            request_times.popleft()
+
+        if len(request_times) >= MAX_ATTEMPTS:
+            raise HTTPException(
+                status_code=429, detail="Too many attempts. Please try again later."
+            )
+
+        request_times.append(now)
+
+
+def check_etag(request: Request, response: Response, resource: str, *parts):
+    """
+    Tag a response for resource with an ETag derived from parts.
 
-    if len(request_times) >= MAX_ATTEMPTS:
-        raise HTTPException(
-            status_code=429, detail="Too many attempts. Please try again later."
-        )
+    Returns a 304 response if the client already holds the current version,
+    otherwise sets the ETag header on response and returns None.
 
-    request_times.append(now)
-    rate_limit[ip_address] = request_times
+    Table versions in parts must be read before the response body is loaded.
+    Versions only move after a commit, so the body is then at least as new as
+    its tag. The tag also changes every ETAG_MAX_AGE seconds.
+    """
+    time_bucket = int(time.time() // ETAG_MAX_AGE)
+    key = (ETAG_SEED, resource, time_bucket, parts)
+    etag = '"{}"'.format(hashlib.blake2b(repr(key).encode(), digest_size=8).hexdigest())
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return None
 
 
 def apartment_return_format(apartment):
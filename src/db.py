@@ -5,6 +5,7 @@ from src.logger import logger
 from sqlalchemy import (
     create_engine,
     Column,
+    Index,
     Integer,
     String,
     ForeignKey,
@@ -13,9 +14,31 @@ from sqlalchemy import (
     Time,
     Boolean,
     func,
+    event,
+    insert,
+    inspect,
+    lambda_stmt,
+    select,
+    text,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+from sqlalchemy.orm import (
+    declarative_base,
+    sessionmaker,
+    relationship,
+    joinedload,
+    object_session,
+    raiseload,
 )
-from sqlalchemy.orm import declarative_base, sessionmaker, relationship, joinedload
 from contextlib import contextmanager
+from collections import defaultdict
+from dataclasses import dataclass
+import threading
+from cachetools import TTLCache, cached
+from cachetools.keys import hashkey
 import src.utils as utils
 from dotenv import load_dotenv
 
@@ -23,10 +46,56 @@ load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./data.db")
 
-engine = create_engine(DATABASE_URL, echo=False)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Enough connections for the request threadpool plus the reader
+engine_options = {
+    "pool_size": int(os.getenv("DB_POOL_SIZE", 20)),
+    "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 10)),
+    # Room for every distinct statement the helpers build, so none get recompiled
+    "query_cache_size": 1200,
+}
+if not DATABASE_URL.startswith("sqlite"):
+    # Drop connections the server closed while they sat idle in the pool
+    engine_options.update(pool_pre_ping=True, pool_recycle=1800)
+
+engine = create_engine(DATABASE_URL, echo=False, **engine_options)
+
+if engine.dialect.name == "sqlite":
+
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        # WAL lets the reader and the API read while another connection writes, and
+        # with WAL synchronous=NORMAL is still safe against corruption
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+# Committed objects keep their loaded state: helpers return them after the session
+# closes, and reloading every row after each commit would cost an extra SELECT
+SessionLocal = sessionmaker(
+    autocommit=False, autoflush=False, expire_on_commit=False, bind=engine
+)
 Base = declarative_base()
 
+# Apartments are close to static, so lookups by number are memoized. Any write to
+# the apartments table goes through _clear_apartment_cache().
+_apartment_cache = TTLCache(maxsize=512, ttl=600)
+_apartment_cache_lock = threading.Lock()
+
+# get_user() is called by most handlers to resolve a target user by id or email.
+# Entries are immutable UserSnapshots, so threads can share them safely. Cached users
+# carry their apartment: user writes drop the affected id and email keys through
+# _forget_user(), apartment writes clear everything.
+_user_cache = TTLCache(maxsize=1024, ttl=60)
+_user_cache_lock = threading.Lock()
+
+# Bearer token lookups run on every authenticated request. Resolved users are
+# kept briefly with the token's expiration, keyed by token hash; revoking a token
+# pops its entry.
+_token_cache = TTLCache(maxsize=10_000, ttl=15)
+_token_cache_lock = threading.Lock()
+
 
 @contextmanager
 def get_db():
@@ -40,14 +109,70 @@ def get_db():
         db.close()
 
 
+def _save(obj, db=None):
+    """Add a row in the caller's session (flushed, caller commits) or in a new one."""
+    if db is not None:
+        db.add(obj)
+        db.flush()
+        return obj
+    with get_db() as db:
+        db.add(obj)
+        db.commit()
+        # Only columns the database filled in (server defaults) still need loading
+        expired = inspect(obj).expired_attributes
+        if expired:
+            db.refresh(obj, list(expired))
+        return obj
+
+
+def _refresh_user(db, user):
+    """Load a user's apartment after commit, since callers read it detached."""
+    db.refresh(user, ["apartment"])
+    return user
+
+
+_MISSING = object()
+
+
 def add_getitem(cls):
+    columns = frozenset(column.key for column in cls.__table__.columns)
+
     def __getitem__(self, key):
+        # Loaded column values sit in the instance dict; read them from there and
+        # only go through the attribute machinery for anything else
+        if key in columns:
+            value = self.__dict__.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
         return getattr(self, key)
 
     cls.__getitem__ = __getitem__
     return cls
 
 
+class utcnow(FunctionElement):
+    """The current UTC time, computed by the database."""
+
+    type = DateTime()
+    inherit_cache = True
+
+
+@compiles(utcnow)
+def _compile_utcnow(element, compiler, **kw):
+    # SQLite keeps CURRENT_TIMESTAMP in UTC
+    return "CURRENT_TIMESTAMP"
+
+
+@compiles(utcnow, "postgresql")
+def _compile_utcnow_postgresql(element, compiler, **kw):
+    return "TIMEZONE('utc', CURRENT_TIMESTAMP)"
+
+
+# Relationships load lazily. Objects returned from the helpers below are used after
+# their session has closed, so each query loads the relationships its callers read
+# with joinedload() - users come with their apartment, pins and RFIDs with their user.
+
+
 @add_getitem
 class Apartment(Base):
     __tablename__ = "apartments"
@@ -56,7 +181,7 @@ class Apartment(Base):
         String, unique=True, nullable=False
     )  # todo: rename to "name", it's a string and we should have the flexibility to use any name, not just numbers
     description = Column(String)
-    users = relationship("User", back_populates="apartment", lazy="joined")
+    users = relationship("User", back_populates="apartment")
 
 
 @add_getitem
@@ -69,8 +194,8 @@ class User(Base):
         String, default="apartment_admin"
     )  # Can be 'apartment_admin', 'admin', or 'guest'
     creator_id = Column(String)
-    apartment_id = Column(Integer, ForeignKey("apartments.id"))
-    apartment = relationship("Apartment", back_populates="users", lazy="joined")
+    apartment_id = Column(Integer, ForeignKey("apartments.id"), index=True)
+    apartment = relationship("Apartment", back_populates="users")
     pins = relationship("Pin", back_populates="user")
     rfids = relationship("Rfid", back_populates="user", foreign_keys="[Rfid.user_id]")
     tokens = relationship("Token", back_populates="user")
@@ -84,54 +209,55 @@ class User(Base):
 class Rfid(Base):
     __tablename__ = "rfids"
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
     hashed_uuid = Column(String, nullable=False)
     salt = Column(String, nullable=False)
     last_four_digits = Column(String(4), nullable=False)
     label = Column(String)
-    created_at = Column(
-        DateTime, default=datetime.datetime.utcnow
-    )  # utcnow is deprecated in newer versions, but this will be likely run on an older version of python
-    user = relationship(
-        "User", back_populates="rfids", foreign_keys=[user_id], lazy="joined"
-    )
+    # default= also covers tables created before the server default existed
+    created_at = Column(DateTime, default=utcnow(), server_default=utcnow(), index=True)
+    user = relationship("User", back_populates="rfids", foreign_keys=[user_id])
 
 
 @add_getitem
 class Pin(Base):
     __tablename__ = "pins"
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
     hashed_pin = Column(String, nullable=False)
     salt = Column(String, nullable=False)
     label = Column(String)
-    created_at = Column(DateTime, default=datetime.datetime.utcnow)
-    user = relationship("User", back_populates="pins", lazy="joined")
+    created_at = Column(DateTime, default=utcnow(), server_default=utcnow(), index=True)
+    user = relationship("User", back_populates="pins")
 
 
 @add_getitem
 class Token(Base):
     __tablename__ = "tokens"
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
-    token_hash = Column(String, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    token_hash = Column(String, nullable=False, index=True)
     expiration = Column(Integer, nullable=False)
-    user = relationship("User", back_populates="tokens", lazy="joined")
+    user = relationship("User", back_populates="tokens")
 
 
 @add_getitem
 class LoginCode(Base):
     __tablename__ = "login_codes"
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
-    code_hash = Column(String, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    code_hash = Column(String, nullable=False, index=True)
     expiration = Column(Integer, nullable=False)
-    user = relationship("User", back_populates="login_codes", lazy="joined")
+    user = relationship("User", back_populates="login_codes")
 
 
 @add_getitem
 class RecurringSchedule(Base):
     __tablename__ = "recurring_schedules"
+    # Access checks look up a guest's schedules for one weekday
+    __table_args__ = (
+        Index("ix_recurring_schedules_user_day", "user_id", "day_of_week"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     day_of_week = Column(Integer)  # 0 for Monday, 6 for Sunday
@@ -144,7 +270,7 @@ class RecurringSchedule(Base):
 class OneTimeAccess(Base):
     __tablename__ = "one_time_accesses"
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
     start_date = Column(Date, nullable=False)
     end_date = Column(Date, nullable=False)
     start_time = Column(Time, nullable=False)
@@ -156,7 +282,7 @@ class APIKey(Base):
     __tablename__ = "api_keys"
 
     key_suffix = Column(String(4), primary_key=True)
-    key_hash = Column(String(64), nullable=False)
+    key_hash = Column(String(64), nullable=False, index=True)
     description = Column(String(200))
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     is_active = Column(Boolean, default=True)
@@ -165,18 +291,71 @@ class APIKey(Base):
     user = relationship("User", back_populates="api_keys")
 
 
-def init_db():
-    Base.metadata.create_all(bind=engine)
+# Per-table write counters, bumped whenever a transaction that inserted, updated
+# or deleted rows through the ORM commits in this process. Used to tell whether
+# cached results are still current.
+_table_versions = defaultdict(int)
 
 
-def add_apartment(number, description=None):
-    with get_db() as db:
-        new_apartment = Apartment(number=number, description=description)
-        db.add(new_apartment)
-        db.commit()
-        db.refresh(new_apartment)
-        logger.info(f"Apartment {number} added with ID {new_apartment.id}")
-        return new_apartment
+@event.listens_for(Base, "after_insert", propagate=True)
+@event.listens_for(Base, "after_update", propagate=True)
+@event.listens_for(Base, "after_delete", propagate=True)
+def _record_table_change(mapper, connection, target):
+    # These fire at flush, before the data is visible to other sessions, so only
+    # note the table here and bump its version once the transaction commits
+    session = object_session(target)
+    session.info.setdefault("changed_tables", set()).add(mapper.local_table.name)
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _bump_changed_table_versions(session):
+    _bump_table_versions(*session.info.pop("changed_tables", ()))
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discard_changed_tables(session):
+    session.info.pop("changed_tables", None)
+
+
+def _bump_table_versions(*table_names):
+    for name in table_names:
+        _table_versions[name] += 1
+
+
+def get_table_versions(*table_names):
+    return tuple(_table_versions[name] for name in table_names)
+
+
+def init_db():
+    Base.metadata.create_all(bind=engine)
+    # create_all() leaves existing tables alone, so indexes added to a model later
+    # have to be created explicitly on databases that predate them
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+
+def warm_up_pool():
+    # Open every pooled connection at startup so the first requests don't pay for it
+    pool_size = engine.pool.size() if hasattr(engine.pool, "size") else 1
+    connections = [engine.connect() for _ in range(pool_size)]
+    for connection in connections:
+        connection.execute(text("SELECT 1"))
+        connection.close()
+    logger.info(f"Database connection pool warmed up ({pool_size} connections)")
+
+
+def add_apartment(number, description=None, db=None):
+    new_apartment = _save(Apartment(number=number, description=description), db)
+    if db is None:
+        _clear_apartment_cache()
+    else:
+        # The row only becomes visible to lookups once the caller commits
+        event.listen(
+            db, "after_commit", lambda session: _clear_apartment_cache(), once=True
+        )
+    logger.info(f"Apartment {number} added with ID {new_apartment.id}")
+    return new_apartment
 
 
 def add_user(user):
@@ -189,50 +368,209 @@ def add_user(user):
             apartment_id=user.get("apartment_id"),
         )
         db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
+        try:
+            db.commit()
+        except IntegrityError:
+            # The unique email constraint decides; no separate lookup beforehand
+            db.rollback()
+            logger.error(f"User with email {new_user.email} already exists")
+            return None
+        _refresh_user(db, new_user)
+        _forget_user(new_user.id, new_user.email)
 
         logger.info(f"User {new_user.email} added with ID {new_user.id}")
 
         return new_user
 
 
-def get_user(identifier):
+def add_users(users):
+    """
+    Insert several users in one statement and one commit.
+
+    Returns the number of users added, or None if any of them already existed, in
+    which case nothing is inserted.
+    """
+    rows = [
+        {
+            "name": user.get("name"),
+            "email": user.get("email"),
+            "role": user.get("role", "apartment_admin"),
+            "creator_id": user.get("creator_id"),
+            "apartment_id": user.get("apartment_id"),
+        }
+        for user in users
+    ]
+    if not rows:
+        return 0
+
+    with get_db() as db:
+        try:
+            db.execute(insert(User), rows)
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            logger.error("Bulk user insert rejected: some emails already exist")
+            return None
+    # Core-level inserts skip the ORM events that record changed tables
+    _bump_table_versions("users")
+    _forget_user(*(row["email"] for row in rows))
+
+    logger.info(f"{len(rows)} users added")
+    return len(rows)
+
+
+def _clear_user_cache():
+    with _user_cache_lock:
+        _user_cache.clear()
+
+
+def _forget_user(*identifiers):
+    """Drop cached get_user() results for ids/emails."""
+    with _user_cache_lock:
+        for identifier in identifiers:
+            _user_cache.pop(hashkey(identifier), None)
+
+
+def _forget_user_tokens(user_id):
+    """Drop cached get_user_by_token() results that resolved to this user."""
+    with _token_cache_lock:
+        for token_hash, (cached_user, _) in list(_token_cache.items()):
+            if cached_user.id == user_id:
+                _token_cache.pop(token_hash, None)
+
+
+def _load_user(identifier):
+    # Lambda statements are built once and then only re-bound, which skips most of
+    # the per-call query construction on these hot lookups
+    if isinstance(identifier, int):
+        stmt = lambda_stmt(lambda: select(User).where(User.id == identifier))
+    elif isinstance(identifier, str):
+        stmt = lambda_stmt(lambda: select(User).where(User.email == identifier))
+    else:
+        return None
+    stmt += lambda s: s.options(joinedload(User.apartment))
+
     with get_db() as db:
-        user = None
-        if isinstance(identifier, int):
-            user = db.query(User).filter(User.id == identifier).first()
-        elif isinstance(identifier, str):
-            user = db.query(User).filter(User.email == identifier).first()
+        user = db.execute(stmt).scalars().first()
+        return UserSnapshot.from_user(user) if user else None
+
+
+def get_user(identifier):
+    key = hashkey(identifier)
+    with _user_cache_lock:
+        user = _user_cache.get(key)
+    if user is not None:
         return user
 
+    # Misses are not stored, so a user created by another process is found as
+    # soon as it exists instead of after the cache entry expires
+    user = _load_user(identifier)
+    if user is not None:
+        with _user_cache_lock:
+            _user_cache[key] = user
+    return user
+
+
+def get_user_apartment_id(user_id):
+    with get_db() as db:
+        return db.query(User.apartment_id).filter(User.id == user_id).scalar()
+
+
+@dataclass(frozen=True)
+class ApartmentSnapshot:
+    """Detached, immutable copy of an apartment row that is safe to cache."""
+
+    id: int
+    number: str
+    description: str
+
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    """Detached, immutable copy of a user row and its apartment, safe to cache."""
+
+    id: int
+    name: str
+    email: str
+    role: str
+    creator_id: str
+    apartment_id: int
+    apartment: ApartmentSnapshot
+
+    @classmethod
+    def from_user(cls, user):
+        apartment = user.apartment
+        return cls(
+            user.id,
+            user.name,
+            user.email,
+            user.role,
+            user.creator_id,
+            user.apartment_id,
+            ApartmentSnapshot(apartment.id, apartment.number, apartment.description)
+            if apartment
+            else None,
+        )
+
+
+def _clear_apartment_cache():
+    with _apartment_cache_lock:
+        _apartment_cache.clear()
 
+
+@cached(_apartment_cache, lock=_apartment_cache_lock)
 def get_apartment_by_number(number):
     with get_db() as db:
-        return db.query(Apartment).filter(Apartment.number == number).first()
+        apartment = db.query(Apartment).filter(Apartment.number == number).first()
+        if apartment:
+            return ApartmentSnapshot(
+                apartment.id, apartment.number, apartment.description
+            )
+        return None
 
 
 def get_apartment_users(apartment_id):
     with get_db() as db:
-        apartment = (
-            db.query(Apartment)
-            .options(joinedload(Apartment.users).joinedload(User.apartment))
-            .filter(Apartment.id == apartment_id)
-            .first()
+        return (
+            db.query(User)
+            .options(joinedload(User.apartment))
+            .filter(User.apartment_id == apartment_id)
+            .all()
         )
-        if apartment:
-            return apartment.users
-        return []
+
+
+# Dialects with INSERT ... ON CONFLICT, used to upsert in a single statement
+_UPSERT_INSERTS = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
 
 
 def save_user(user):
+    upsert_insert = _UPSERT_INSERTS.get(engine.dialect.name)
+    if upsert_insert is not None:
+        stmt = upsert_insert(User).values(**user)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[User.email],
+            set_={key: stmt.excluded[key] for key in user if key != "email"}
+            or {"email": stmt.excluded.email},
+        ).returning(User.id)
+        with get_db() as db:
+            user_id = db.execute(stmt).scalar_one()
+            db.commit()
+            saved_user = db.get(User, user_id, options=[joinedload(User.apartment)])
+        _bump_table_versions("users")  # The upsert bypasses the ORM events
+        _forget_user(saved_user.id, saved_user.email)
+        _forget_user_tokens(saved_user.id)
+        logger.info(f"User {saved_user.email} saved")
+        return saved_user
+
     with get_db() as db:
         existing_user = db.query(User).filter(User.email == user["email"]).first()
         if existing_user:
             for key, value in user.items():
                 setattr(existing_user, key, value)
             db.commit()
-            db.refresh(existing_user)
+            _refresh_user(db, existing_user)
+            _forget_user(existing_user.id, existing_user.email)
+            _forget_user_tokens(existing_user.id)
             logger.info(f"User {existing_user.email} updated")
             return existing_user
         else:
@@ -241,10 +579,11 @@ def save_user(user):
 
 def update_user(user_id, updated_user):
     with get_db() as db:
-        user = db.query(User).filter(User.id == user_id).first()
+        user = db.get(User, user_id)
         if not user:
             logger.error(f"User with id {user_id} not found")
             return None
+        previous_email = user.email
 
         if "email" in updated_user:
             new_email = updated_user["email"]
@@ -275,17 +614,58 @@ def update_user(user_id, updated_user):
                 setattr(user, key, value)
 
         db.commit()
-        db.refresh(user)
+        _refresh_user(db, user)
+        _forget_user(user.id, previous_email, user.email)
+        # Cached token lookups carry the old role and apartment
+        _forget_user_tokens(user.id)
         logger.info(f"User {user.id} updated")
         return user
 
 
+def purge_expired_credentials(current_time=None):
+    """Delete expired tokens and login codes; returns how many of each were removed."""
+    if current_time is None:
+        current_time = int(time.time())
+    with get_db() as db:
+        tokens = (
+            db.query(Token)
+            .filter(Token.expiration <= current_time)
+            .delete(synchronize_session=False)
+        )
+        login_codes = (
+            db.query(LoginCode)
+            .filter(LoginCode.expiration <= current_time)
+            .delete(synchronize_session=False)
+        )
+        db.commit()
+    if tokens or login_codes:
+        logger.info(f"Purged {tokens} expired tokens and {login_codes} login codes")
+    return tokens, login_codes
+
+
+def delete_token_by_hash(user_id, token_hash):
+    with get_db() as db:
+        deleted = (
+            db.query(Token)
+            .filter(Token.user_id == user_id, Token.token_hash == token_hash)
+            .delete(synchronize_session=False)
+        )
+        db.commit()
+        with _token_cache_lock:
+            _token_cache.pop(token_hash, None)
+        if deleted:
+            logger.info(f"Token of user {user_id} deleted")
+        return deleted
+
+
 def delete_token(token_id):
     with get_db() as db:
-        token = db.query(Token).filter(Token.id == token_id).first()
+        token = db.get(Token, token_id)
         if token:
             db.delete(token)
             db.commit()
+            with _token_cache_lock:
+                _token_cache.pop(token.token_hash, None)
             logger.info(f"Token {token_id} deleted")
             return True
         return False
@@ -304,30 +684,29 @@ def extend_token_expiration(token, new_expiration):
         return False
 
 
-def save_rfid(user_id, hashed_uuid, salt, last_four_digits, label):
-    with get_db() as db:
-        new_rfid = Rfid(
+def save_rfid(user_id, hashed_uuid, salt, last_four_digits, label, db=None):
+    new_rfid = _save(
+        Rfid(
             user_id=user_id,
             hashed_uuid=hashed_uuid,
             salt=salt,
             last_four_digits=last_four_digits,
             label=label,
-        )
-        db.add(new_rfid)
-        db.commit()
-        db.refresh(new_rfid)
-        logger.info(f"RFID {label} registered for user {user_id}")
-        return new_rfid
+        ),
+        db,
+    )
+    logger.info(f"RFID {label} registered for user {user_id}")
+    return new_rfid
 
 
 def get_rfid(rfid_id):
     with get_db() as db:
-        return db.query(Rfid).filter(Rfid.id == rfid_id).first()
+        return db.get(Rfid, rfid_id, options=[joinedload(Rfid.user)])
 
 
 def delete_rfid(rfid_id):
     with get_db() as db:
-        rfid = db.query(Rfid).filter(Rfid.id == rfid_id).first()
+        rfid = db.get(Rfid, rfid_id, options=[joinedload(Rfid.user)])
         if rfid:
             db.delete(rfid)
             db.commit()
@@ -337,125 +716,113 @@ def delete_rfid(rfid_id):
         return False
 
 
-def get_all_rfids():
-    with get_db() as db:
-        return db.query(Rfid).all()
-
-
 def get_all_users():
     with get_db() as db:
-        return db.query(User).all()
+        return db.query(User).options(joinedload(User.apartment)).all()
 
 
-def get_user_by_login_code(login_code):
-    code_hash = utils.hash_secret(login_code)
-    current_time = int(time.time())
-
-    with get_db() as db:
-        user = (
-            db.query(User)
-            .join(LoginCode)
-            .filter(
-                LoginCode.code_hash == code_hash, LoginCode.expiration > current_time
-            )
-            .options(joinedload(User.apartment))
-            .first()
-        )
-
-        return user
-
+def redeem_login_code(email, login_code, token_hash, token_expiration, current_time):
+    """
+    Exchange a login code for a new bearer token in a single transaction.
 
-def is_login_code_expired(user_id, login_code, current_time):
+    Returns a (user, expired) tuple. user is None if no code matches the email;
+    expired is True if the code matched but had expired (it is removed either way).
+    """
     code_hash = utils.hash_secret(login_code)
 
     with get_db() as db:
-        login_code = (
+        stored_code = (
             db.query(LoginCode)
-            .filter(LoginCode.user_id == user_id, LoginCode.code_hash == code_hash)
+            .join(User)
+            .filter(LoginCode.code_hash == code_hash, User.email == email)
             .first()
         )
+        if not stored_code:
+            return None, False
+
+        user = stored_code.user
+        db.delete(stored_code)
+        expired = current_time > stored_code.expiration
+        if not expired:
+            save_token(user.id, token_hash, token_expiration, db=db)
+        db.commit()
+        _refresh_user(db, user)
 
-        return login_code is None or current_time > login_code.expiration
-
-
-def remove_login_code(user_id, login_code):
-    code_hash = utils.hash_secret(login_code)
-    with get_db() as db:
-        login_code = (
-            db.query(LoginCode)
-            .filter(LoginCode.user_id == user_id, LoginCode.code_hash == code_hash)
-            .first()
-        )
-        if login_code:
-            db.delete(login_code)
-            db.commit()
-            logger.info(f"Login code removed for user {user_id}")
-            return True
-        return False
+        if expired:
+            logger.info(f"Expired login code removed for user {user.id}")
+            return user, True
+        logger.info(f"Login code exchanged for a token for user {user.id}")
+        return user, False
 
 
-def get_user_by_token(token):
+def get_user_by_token(token, use_cache=True):
     token_hash = utils.hash_secret(token)
     current_time = int(time.time())
 
+    if use_cache:
+        with _token_cache_lock:
+            cached_entry = _token_cache.get(token_hash)
+        # A cached token still has to be unexpired right now
+        if cached_entry is not None and cached_entry[1] > current_time:
+            return cached_entry[0]
+
+    stmt = lambda_stmt(
+        lambda: select(User, Token.expiration)
+        .join(Token)
+        .where(Token.token_hash == token_hash, Token.expiration > current_time)
+        # Callers only read the apartment; anything else would be an accidental query
+        .options(joinedload(User.apartment), raiseload("*"))
+        .limit(1)
+    )
     with get_db() as db:
-        user = (
-            db.query(User)
-            .populate_existing()  # This bypasses SQLAlchemy's session-level cache
-            .join(Token)
-            .filter(Token.token_hash == token_hash, Token.expiration > current_time)
-            .first()
-        )
+        row = db.execute(stmt).first()
+    if row is None:
+        return None
 
-        return user
+    user, expiration = row
+    if use_cache:
+        with _token_cache_lock:
+            _token_cache[token_hash] = (user, expiration)
+    return user
 
 
-def save_token(user_id, token_hash, expiration):
-    with get_db() as db:
-        new_token = Token(user_id=user_id, token_hash=token_hash, expiration=expiration)
-        db.add(new_token)
-        db.commit()
-        db.refresh(new_token)
-        logger.info(f"Token added for user {user_id}")
-        return new_token
+def save_token(user_id, token_hash, expiration, db=None):
+    new_token = _save(
+        Token(user_id=user_id, token_hash=token_hash, expiration=expiration), db
+    )
+    logger.info(f"Token added for user {user_id}")
+    return new_token
 
 
-def save_login_code(user_id, code_hash, expiration):
-    with get_db() as db:
-        new_code = LoginCode(
-            user_id=user_id, code_hash=code_hash, expiration=expiration
-        )
-        db.add(new_code)
-        db.commit()
-        db.refresh(new_code)
-        logger.info(f"Login code added for user {user_id}")
-        return new_code
+def save_login_code(user_id, code_hash, expiration, db=None):
+    new_code = _save(
+        LoginCode(user_id=user_id, code_hash=code_hash, expiration=expiration), db
+    )
+    logger.info(f"Login code added for user {user_id}")
+    return new_code
 
 
-def save_pin(user_id, hashed_pin, label, salt):
-    with get_db() as db:
-        new_pin = Pin(user_id=user_id, hashed_pin=hashed_pin, label=label, salt=salt)
-        db.add(new_pin)
-        db.commit()
-        db.refresh(new_pin)
-        logger.info(f"Pin {label} added for user {user_id}")
-        return new_pin
+def save_pin(user_id, hashed_pin, label, salt, db=None):
+    new_pin = _save(
+        Pin(user_id=user_id, hashed_pin=hashed_pin, label=label, salt=salt), db
+    )
+    logger.info(f"Pin {label} added for user {user_id}")
+    return new_pin
 
 
 def get_pin(pin_id):
     with get_db() as db:
-        return db.query(Pin).filter(Pin.id == pin_id).first()
+        return db.get(Pin, pin_id, options=[joinedload(Pin.user)])
 
 
 def update_pin(pin_id, hashed_pin, label, salt):
     with get_db() as db:
-        pin = db.query(Pin).filter(Pin.id == pin_id).first()
+        pin = db.get(Pin, pin_id)
         if pin:
             pin.hashed_pin = hashed_pin
             pin.label = label
             pin.salt = salt
             db.commit()
-            db.refresh(pin)
             logger.info(f"Pin {label} updated for pin {pin_id}")
             return pin
         return None
@@ -463,7 +830,7 @@ def update_pin(pin_id, hashed_pin, label, salt):
 
 def delete_pin(pin_id):
     with get_db() as db:
-        pin = db.query(Pin).filter(Pin.id == pin_id).first()
+        pin = db.get(Pin, pin_id)
         if pin:
             db.delete(pin)
             db.commit()
@@ -475,7 +842,7 @@ def delete_pin(pin_id):
 
 def remove_pin(pin_id):
     with get_db() as db:
-        pin = db.query(Pin).filter(Pin.id == pin_id).first()
+        pin = db.get(Pin, pin_id)
         if pin:
             db.delete(pin)
             db.commit()
@@ -494,17 +861,36 @@ def get_pins_by_apartment(apartment_id):
         return db.query(Pin).join(User).filter(User.apartment_id == apartment_id).all()
 
 
-def get_all_pins():
+def get_pin_credentials():
+    """Salt, hash, owner id and owner role of every PIN, as plain rows."""
+    with get_db() as db:
+        return (
+            db.query(Pin.salt, Pin.hashed_pin, Pin.user_id, User.role.label("user_role"))
+            .join(User, Pin.user_id == User.id)  # PINs of deleted users don't count
+            .all()
+        )
+
+
+def get_rfid_credentials():
+    """Salt, hash, owner id and owner role of every RFID, as plain rows."""
     with get_db() as db:
-        return db.query(Pin).all()
+        return (
+            db.query(
+                Rfid.salt, Rfid.hashed_uuid, Rfid.user_id, User.role.label("user_role")
+            )
+            .join(User, Rfid.user_id == User.id)  # RFIDs of deleted users don't count
+            .all()
+        )
 
 
 def remove_user(user_id):
     with get_db() as db:
-        user = db.query(User).filter(User.id == user_id).first()
+        user = db.get(User, user_id)
         if user:
             db.delete(user)
             db.commit()
+            _forget_user(user.id, user.email)
+            _forget_user_tokens(user.id)
             logger.info(f"User {user.email} deleted")
             return True
         return False
@@ -515,14 +901,20 @@ def get_all_apartments():
         return db.query(Apartment).all()
 
 
+def get_apartment(apartment_id):
+    with get_db() as db:
+        return db.get(Apartment, apartment_id)
+
+
 def update_apartment(apartment_id, updated_data):
     with get_db() as db:
-        apartment = db.query(Apartment).filter(Apartment.id == apartment_id).first()
+        apartment = db.get(Apartment, apartment_id)
         if apartment:
             for key, value in updated_data.items():
                 setattr(apartment, key, value)
             db.commit()
-            db.refresh(apartment)
+            _clear_apartment_cache()
+            _clear_user_cache()
             logger.info(f"Apartment {apartment.number} updated")
             return apartment
         return None
@@ -530,10 +922,13 @@ def update_apartment(apartment_id, updated_data):
 
 def remove_apartment(apartment_id):
     with get_db() as db:
-        apartment = db.query(Apartment).filter(Apartment.id == apartment_id).first()
+        apartment = db.get(Apartment, apartment_id)
         if apartment:
             # Check if there are any users associated with this apartment
-            if apartment.users:
+            has_users = db.query(
+                select(User.id).where(User.apartment_id == apartment_id).exists()
+            ).scalar()
+            if has_users:
                 logger.error(
                     f"Cannot delete apartment {apartment.number} - it still has users associated with it"
                 )
@@ -541,29 +936,45 @@ def remove_apartment(apartment_id):
 
             db.delete(apartment)
             db.commit()
+            _clear_apartment_cache()
             logger.info(f"Apartment {apartment.number} deleted")
             return True
         return False
 
 
-def get_apartment_pins(apartment_id):
-    with get_db() as db:
-        return db.query(Pin).join(User).filter(User.apartment_id == apartment_id).all()
-
-
-def get_user_pins(user_id):
+def get_pin_rows(apartment_id=None, user_id=None):
+    """Plain rows for PIN listings, with the owner's email joined in one query."""
     with get_db() as db:
-        return db.query(Pin).filter(Pin.user_id == user_id).all()
-
-
-def get_apartment_rfids(apartment_id):
+        query = db.query(
+            Pin.id,
+            Pin.label,
+            Pin.created_at,
+            Pin.user_id,
+            User.email.label("user_email"),
+        ).outerjoin(User, Pin.user_id == User.id)
+        if apartment_id is not None:
+            query = query.filter(User.apartment_id == apartment_id)
+        if user_id is not None:
+            query = query.filter(Pin.user_id == user_id)
+        return query.all()
+
+
+def get_rfid_rows(apartment_id=None, user_id=None):
+    """Plain rows for RFID listings, with the owner's email joined in one query."""
     with get_db() as db:
-        return db.query(Rfid).join(User).filter(User.apartment_id == apartment_id).all()
-
-
-def get_user_rfids(user_id):
-    with get_db() as db:
-        return db.query(Rfid).filter(Rfid.user_id == user_id).all()
+        query = db.query(
+            Rfid.id,
+            Rfid.label,
+            Rfid.created_at,
+            Rfid.user_id,
+            User.email.label("user_email"),
+            Rfid.last_four_digits,
+        ).outerjoin(User, Rfid.user_id == User.id)
+        if apartment_id is not None:
+            query = query.filter(User.apartment_id == apartment_id)
+        if user_id is not None:
+            query = query.filter(Rfid.user_id == user_id)
+        return query.all()
 
 
 def add_recurring_schedule(user_id, day_of_week, start_time, end_time):
@@ -576,7 +987,6 @@ def add_recurring_schedule(user_id, day_of_week, start_time, end_time):
         )
         db.add(new_schedule)
         db.commit()
-        db.refresh(new_schedule)
         logger.info(f"Recurring guest schedule added for user {user_id}")
         return new_schedule
 
@@ -592,7 +1002,6 @@ def add_one_time_access(user_id, start_date, end_date, start_time, end_time):
         )
         db.add(new_access)
         db.commit()
-        db.refresh(new_access)
         logger.info(f"One-time guest access added for user {user_id}")
         return new_access
 
@@ -613,25 +1022,17 @@ def get_recurring_schedules_by_user(user_id):
 
 def get_recurring_schedule(schedule_id):
     with get_db() as db:
-        return (
-            db.query(RecurringSchedule)
-            .filter(RecurringSchedule.id == schedule_id)
-            .first()
-        )
+        return db.get(RecurringSchedule, schedule_id)
 
 
 def get_one_time_access(access_id):
     with get_db() as db:
-        return db.query(OneTimeAccess).filter(OneTimeAccess.id == access_id).first()
+        return db.get(OneTimeAccess, access_id)
 
 
 def remove_recurring_schedule(schedule_id):
     with get_db() as db:
-        schedule = (
-            db.query(RecurringSchedule)
-            .filter(RecurringSchedule.id == schedule_id)
-            .first()
-        )
+        schedule = db.get(RecurringSchedule, schedule_id)
         if schedule:
             db.delete(schedule)
             db.commit()
@@ -642,7 +1043,7 @@ def remove_recurring_schedule(schedule_id):
 
 def remove_one_time_access(access_id):
     with get_db() as db:
-        access = db.query(OneTimeAccess).filter(OneTimeAccess.id == access_id).first()
+        access = db.get(OneTimeAccess, access_id)
         if access:
             db.delete(access)
             db.commit()
@@ -652,63 +1053,49 @@ def remove_one_time_access(access_id):
 
 
 def is_user_allowed_access(user_id):
-    with get_db() as db:
-        user = db.query(User).filter(User.id == user_id).first()
-        if user and user.role == "guest":
-            # First check if the user has any schedules at all
-            has_recurring = (
-                db.query(RecurringSchedule)
-                .filter(RecurringSchedule.user_id == user_id)
-                .first()
-                is not None
-            )
-
-            has_one_time = (
-                db.query(OneTimeAccess).filter(OneTimeAccess.user_id == user_id).first()
-                is not None
-            )
+    now = datetime.datetime.now()
+    current_time = now.time()
+    current_date = now.date()
+    current_day = now.weekday()
+
+    # The role and every schedule check come back as one row from one round-trip
+    recurring = select(RecurringSchedule.id).where(
+        RecurringSchedule.user_id == user_id
+    )
+    one_time = select(OneTimeAccess.id).where(OneTimeAccess.user_id == user_id)
+    stmt = select(
+        User.role,
+        recurring.exists().label("has_recurring"),
+        one_time.exists().label("has_one_time"),
+        recurring.where(
+            RecurringSchedule.day_of_week == current_day,
+            RecurringSchedule.start_time <= current_time,
+            RecurringSchedule.end_time >= current_time,
+        )
+        .exists()
+        .label("recurring_access"),
+        one_time.where(
+            OneTimeAccess.start_date <= current_date,
+            OneTimeAccess.end_date >= current_date,
+            OneTimeAccess.start_time <= current_time,
+            OneTimeAccess.end_time >= current_time,
+        )
+        .exists()
+        .label("one_time_access"),
+    ).where(User.id == user_id)
 
-            # If no schedules exist, allow access
-            if not has_recurring and not has_one_time:
-                logger.info("Guest user has no schedules - allowing access")
-                return True
-
-            now = datetime.datetime.now()
-            current_time = now.time()
-            current_date = now.date()
-            current_day = now.weekday()
-
-            # Check recurring schedule
-            recurring_access = (
-                db.query(RecurringSchedule)
-                .filter(
-                    RecurringSchedule.user_id == user_id,
-                    RecurringSchedule.day_of_week == current_day,
-                    RecurringSchedule.start_time <= current_time,
-                    RecurringSchedule.end_time >= current_time,
-                )
-                .first()
-            )
+    with get_db() as db:
+        row = db.execute(stmt).first()
 
-            if recurring_access:
-                return True
-
-            # Check one-time access
-            one_time_access = (
-                db.query(OneTimeAccess)
-                .filter(
-                    OneTimeAccess.user_id == user_id,
-                    OneTimeAccess.start_date <= current_date,
-                    OneTimeAccess.end_date >= current_date,
-                    OneTimeAccess.start_time <= current_time,
-                    OneTimeAccess.end_time >= current_time,
-                )
-                .first()
-            )
+    if row is None or row.role != "guest":
+        return True  # Non-guest users are always allowed access
 
-            return one_time_access is not None
+    # If no schedules exist, allow access
+    if not row.has_recurring and not row.has_one_time:
+        logger.info("Guest user has no schedules - allowing access")
+        return True
 
-        return True  # Non-guest users are always allowed access
+    return bool(row.recurring_access or row.one_time_access)
 
 
 def get_all_api_keys():
@@ -738,7 +1125,7 @@ def add_api_key(suffix, key_hash, description, user_id):
         )
         db.add(api_key)
         db.commit()
-        db.refresh(api_key)
+        db.refresh(api_key, ["created_at"])
         return api_key
 
 
@@ -759,4 +1146,4 @@ def get_api_key(key_suffix):
 
 def get_api_key_owner(user_id):
     with get_db() as db:
-        return db.query(User).filter(User.id == user_id).first()
+        return db.get(User, user_id)
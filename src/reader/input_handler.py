@@ -1,11 +1,12 @@
 import asyncio
 from collections import deque
+from functools import lru_cache
 from src.logger import logger
 import os
 from dotenv import load_dotenv
 
 try:
-    from evdev import InputDevice, categorize, ecodes, list_devices  # type: ignore
+    from evdev import InputDevice, ecodes, list_devices  # type: ignore
 except ImportError:
     logger.error(
         "Failed to import evdev. Make sure you have the evdev library installed in production."
@@ -16,7 +17,8 @@ load_dotenv()
 
 INPUT_SOURCE = os.getenv("INPUT_SOURCE", "stdin")
 MAX_INPUT_LENGTH = 20  # Set a reasonable maximum length for input
-PIN_LENGTH = os.getenv("PIN_LENGTH", 4)
+KEYBOARD_RETRY_DELAY = 1  # Seconds to wait before scanning again after a failure
+PIN_LENGTH = int(os.getenv("PIN_LENGTH", 4))
 
 KEY_CODES = {
     "0225": "1",
@@ -34,7 +36,16 @@ KEY_CODES = {
 }
 
 
-def find_keyboards():
+# Keyboards stay open between reads; they are only rescanned after one fails
+_keyboards = []
+
+
+def find_keyboards(force=False):
+    global _keyboards
+    if _keyboards and not force:
+        return _keyboards
+    close_keyboards()
+
     device_paths = list_devices()
     keyboards = []
     for path in device_paths:
@@ -47,9 +58,21 @@ def find_keyboards():
         except Exception as e:
             logger.error(f"Error accessing device {path}: {e}")
             device.close()
+    _keyboards = keyboards
     return keyboards
 
 
+def close_keyboards():
+    """Close the cached keyboards so the next find_keyboards() call rescans."""
+    global _keyboards
+    for device in _keyboards:
+        try:
+            device.close()
+        except OSError:
+            pass  # The device is already gone
+    _keyboards = []
+
+
 def decode_keypad_input(input_sequence):
     return KEY_CODES.get(input_sequence, "")
 
@@ -66,25 +89,33 @@ async def read_input():
             # Start the input reading task
             read_task = asyncio.create_task(read_evdev(input_queue))
 
+            get_task = asyncio.create_task(input_queue.get())
             try:
-                # Just wait for the input without timeout
-                result = await input_queue.get()
-                read_task.cancel()  # Cancel the reading task once we have input
-                return result
+                # Wait without timeout for either input or the reading task ending,
+                # which only happens when no keyboard is found or one fails
+                await asyncio.wait(
+                    {get_task, read_task}, return_when=asyncio.FIRST_COMPLETED
+                )
+                if get_task.done():
+                    return get_task.result()
+                logger.error("Keyboard reading stopped, scanning again shortly")
+                await asyncio.sleep(KEYBOARD_RETRY_DELAY)
+                return None
             except Exception as e:
                 logger.error(f"Error in read_input: {e}")
-                try:
-                    read_task.cancel()
-                except Exception as cancel_exception:
-                    logger.error(f"Error cancelling read_task: {cancel_exception}")
                 return None
+            finally:
+                # Cancel whichever task is still running once we have a result
+                get_task.cancel()
+                read_task.cancel()
+                await asyncio.gather(get_task, read_task, return_exceptions=True)
         except Exception as e:
             logger.error(f"Error in read_input: {e}")
             return None
 
 
 async def read_stdin():
-    loop = asyncio.get_event_loop()
+    loop = asyncio.get_running_loop()
     try:
         # Remove wait_for and just use run_in_executor directly
         input_value = await loop.run_in_executor(
@@ -145,86 +176,116 @@ async def read_evdev(input_queue):
 
 async def read_keyboard_events(device, input_buffer, t9em_input_buffer, input_queue):
     timeout = int(os.getenv("INPUT_TIMEOUT", 10))
+    loop = asyncio.get_running_loop()
+    key_table = get_key_table()
+    ev_key = ecodes.EV_KEY  # Bound once instead of looked up on every event
     try:
-        first_key_received = False
-        start_time = None
+        # Set on the first keypress; the buffers are cleared if input is still
+        # incomplete when it passes
+        deadline = None
 
         async for event in device.async_read_loop():
-            if event.type == ecodes.EV_KEY:
-                data = categorize(event)
-                if data.keystate == 1:  # Key down events only
+            if event.type == ev_key:
+                # Read the raw event rather than building a KeyEvent via categorize()
+                if event.value == 1:  # Key down events only
+                    now = loop.time()
                     # Start timing from first keypress
-                    if not first_key_received:
-                        first_key_received = True
-                        start_time = asyncio.get_event_loop().time()
+                    if deadline is None:
+                        deadline = now + timeout
 
-                    key = process_key(data.keycode)
+                    key = key_table.get(event.code)
                     if key:
-                        if start_time is not None:
-                            if asyncio.get_event_loop().time() - start_time > timeout:
-                                logger.debug(
-                                    "Timeout reached after first keypress, clearing buffers"
-                                )
-                                input_buffer.clear()
-                                t9em_input_buffer.clear()
-                                first_key_received = False
-                                start_time = None
-
-                        if INPUT_SOURCE == "t9em":
-                            # Handle t9em input mode
-                            if key == "ENTER":
-                                input_sequence = "".join(t9em_input_buffer)
-                                decoded_key = decode_keypad_input(input_sequence)
-                                if decoded_key:
-                                    if (
-                                        decoded_key == "*" or decoded_key == "#"
-                                    ):  # these buttons reset the input buffer
-                                        input_buffer.clear()
-                                        t9em_input_buffer.clear()
-                                        first_key_received = False
-                                        start_time = None
-                                    else:
-                                        input_buffer.append(decoded_key)
-                                else:  # this means an rfid was scanned
-                                    await input_queue.put(input_sequence)
-                                    input_buffer.clear()  # should be empty anyway
-                                # check if the input buffer is the length of the PIN_LENGTH or longer
-                                if len(input_buffer) >= PIN_LENGTH:
-                                    result = "".join(input_buffer)
-                                    await input_queue.put(result)
-                                    input_buffer.clear()
-                                t9em_input_buffer.clear()
-                                first_key_received = False
-                                start_time = None
-                            else:
-                                t9em_input_buffer.append(key)
-                        else:
-                            if key.isdigit() or (key.isalpha() and key != "ENTER"):
-                                input_buffer.append(key)
-                            elif key == "ENTER":
-                                result = "".join(input_buffer)
-                                await input_queue.put(result)
-                                input_buffer.clear()
-                                first_key_received = False
-                                start_time = None
+                        if now > deadline:
+                            logger.debug(
+                                "Timeout reached after first keypress, clearing buffers"
+                            )
+                            input_buffer.clear()
+                            t9em_input_buffer.clear()
+                            deadline = None
+
+                        if await _handle_key(
+                            key, input_buffer, t9em_input_buffer, input_queue
+                        ):
+                            deadline = None
 
     except asyncio.CancelledError:
         pass  # This is expected when the task is cancelled
+    except OSError as e:
+        # The device was unplugged or reset; drop the cached handles so the next
+        # read scans for keyboards again
+        logger.error(f"Error reading keyboard events: {e}")
+        close_keyboards()
+        raise
     except Exception as e:
         logger.error(f"Error reading keyboard events: {e}")
         raise
-    finally:
-        device.close()  # Ensure the InputDevice is closed properly
+
+
+async def _handle_t9em_key(key, input_buffer, t9em_input_buffer, input_queue):
+    """Handle a key from a t9em keypad; returns True when an input was finished."""
+    if key != "ENTER":
+        t9em_input_buffer.append(key)
+        return False
+
+    input_sequence = "".join(t9em_input_buffer)
+    decoded_key = decode_keypad_input(input_sequence)
+    if decoded_key:
+        if decoded_key == "*" or decoded_key == "#":
+            # these buttons reset the input buffer
+            input_buffer.clear()
+            t9em_input_buffer.clear()
+            return True
+        input_buffer.append(decoded_key)
+    else:  # this means an rfid was scanned
+        await input_queue.put(input_sequence)
+        input_buffer.clear()  # should be empty anyway
+    # check if the input buffer is the length of the PIN_LENGTH or longer
+    if len(input_buffer) >= PIN_LENGTH:
+        result = "".join(input_buffer)
+        await input_queue.put(result)
+        input_buffer.clear()
+    t9em_input_buffer.clear()
+    return True
+
+
+async def _handle_keyboard_key(key, input_buffer, t9em_input_buffer, input_queue):
+    """Handle a key from a regular keyboard; returns True when an input was finished."""
+    if key.isdigit() or (key.isalpha() and key != "ENTER"):
+        input_buffer.append(key)
+    elif key == "ENTER":
+        result = "".join(input_buffer)
+        await input_queue.put(result)
+        input_buffer.clear()
+        return True
+    return False
+
+
+# INPUT_SOURCE is fixed for the life of the process, so pick the key handler once
+# instead of checking the mode on every keypress
+_handle_key = _handle_t9em_key if INPUT_SOURCE == "t9em" else _handle_keyboard_key
+
+
+@lru_cache(maxsize=1)
+def get_key_table():
+    """Map every evdev key code straight to the key process_key() would return."""
+    table = {}
+    for code, keycode in ecodes.keys.items():
+        key = process_key(keycode)
+        if key:
+            table[code] = key
+    return table
 
 
 def process_key(keycode):
     if isinstance(keycode, list):
-        key_code = keycode[0]
-    else:
-        key_code = keycode
+        keycode = keycode[0]
+    return _process_key(keycode)
 
-    logger.debug(f"Processing keycode: {key_code}")
 
+# A keypad only ever produces a handful of key names, so after the first press of
+# each key this is a dictionary hit
+@lru_cache(maxsize=256)
+def _process_key(key_code):
     if "KEY_" in key_code:
         return key_code.split("_")[1].replace("KP", "")
     return None
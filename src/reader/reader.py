@@ -1,29 +1,65 @@
+import hmac
 import os
+import time
 import src.utils as utils
 from dotenv import load_dotenv
-from src.db import get_all_pins, get_all_rfids, is_user_allowed_access
-from src.reader.input_handler import read_input
+from src.db import (
+    get_pin_credentials,
+    get_rfid_credentials,
+    get_table_versions,
+    is_user_allowed_access,
+)
+from src.reader.input_handler import close_keyboards, read_input
 from src.logger import logger
 from src.door_manager import door_manager
 import asyncio
 
 load_dotenv()
 INPUT_TIMEOUT = int(os.getenv("INPUT_TIMEOUT", 10))
+CREDENTIAL_CACHE_TTL = int(os.getenv("CREDENTIAL_CACHE_TTL", 60))
 
 input_queue = asyncio.Queue()
 reader_status = "stopped"
 task_running = False
 reader_task = None
 
+# Credential rows from the last lookup, keyed by kind and stored with the table
+# versions they were read at. They are reloaded after a write to those tables in
+# this process, and after CREDENTIAL_CACHE_TTL seconds to pick up writes made by
+# other processes (e.g. setup.py)
+_credential_cache = {}
+
+
+def _get_credentials(kind, loader, *table_names):
+    versions = get_table_versions(*table_names)
+    now = time.monotonic()
+    cached = _credential_cache.get(kind)
+    if cached is None or cached[0] != versions or now > cached[1]:
+        # Plain tuples unpack faster than Row objects in the per-entry loops
+        rows = tuple(tuple(row) for row in loader())
+        cached = (versions, now + CREDENTIAL_CACHE_TTL, rows)
+        _credential_cache[kind] = cached
+    return cached[2]
+
+
+def clear_credential_cache():
+    """Drop the cached credentials so the next entry reads them from the database."""
+    _credential_cache.clear()
+
 
 def check_input(input_value):
     # Check if it's a PIN
-    all_pins = get_all_pins()
-    for pin in all_pins:
-        if utils.hash_secret(input_value, pin.salt) == pin.hashed_pin:
+    all_pins = _get_credentials("pins", get_pin_credentials, "pins", "users")
+    for salt, hashed_pin, user_id, user_role in all_pins:
+        if hmac.compare_digest(utils.hash_secret(input_value, salt), hashed_pin):
+            if user_role is None:
+                # Credentials only come from existing users, so this is a user whose
+                # role was never set; deny rather than guess what access they have
+                logger.warning(f"PIN of user {user_id} without a role used")
+                return False
             # If it's a guest user, check their access schedule
-            if pin.user.role == "guest":
-                if is_user_allowed_access(pin.user.id):
+            if user_role == "guest":
+                if is_user_allowed_access(user_id):
                     logger.info("Valid PIN used by guest with valid access schedule")
                     return True
                 else:
@@ -36,12 +72,16 @@ def check_input(input_value):
             return True
 
     # If not a PIN, check if it's an RFID
-    all_rfids = get_all_rfids()
-    for rfid in all_rfids:
-        if utils.hash_secret(input_value, rfid.salt) == rfid.hashed_uuid:
+    all_rfids = _get_credentials("rfids", get_rfid_credentials, "rfids", "users")
+    for salt, hashed_uuid, user_id, user_role in all_rfids:
+        if hmac.compare_digest(utils.hash_secret(input_value, salt), hashed_uuid):
+            if user_role is None:
+                # As with PINs, deny users whose role was never set
+                logger.warning(f"RFID of user {user_id} without a role used")
+                return False
             # If it's a guest user, check their access schedule
-            if rfid.user.role == "guest":
-                if is_user_allowed_access(rfid.user.id):
+            if user_role == "guest":
+                if is_user_allowed_access(user_id):
                     logger.info("Valid RFID used by guest with valid access schedule")
                     return True
                 else:
@@ -88,7 +128,9 @@ async def input_processor():
             input_value = await asyncio.wait_for(input_queue.get(), timeout=1)
             logger.debug(f"Input value: {input_value}")
             if input_value:
-                if check_input(input_value) is True:
+                # check_input queries the database and hashes every candidate, so
+                # keep it off the event loop the API is served from
+                if await asyncio.to_thread(check_input, input_value) is True:
                     await door_manager.unlock(
                         utils.unlock_door, utils.RELAY_ACTIVATION_TIME
                     )
@@ -109,6 +151,7 @@ def start_reader():
     if not task_running:
         task_running = True
         reader_status = "running"
+        clear_credential_cache()  # Start from current credentials after a restart
         loop = asyncio.get_event_loop()
         # Create separate tasks for reader and processor
         reader_task_1 = loop.create_task(input_reader())
@@ -134,6 +177,7 @@ async def stop_reader():
             except Exception as e:
                 logger.error(f"Error during reader shutdown: {e}")
             finally:
+                close_keyboards()  # Release the input devices kept open between reads
                 logger.info("Reader stop requested")
     else:
         logger.warning("Reader is not running")